@@ -1,27 +1,127 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial, lru_cache
+import multiprocessing
 import os
 from dataclasses import asdict
 import inspect
+import numpy as np
 import matplotlib.pyplot as plt
 import h5py
+import numba
 from pde import CartesianGrid, ScalarField, FileStorage, LivePlotTracker
-from pde import DataTracker
-from pde.grids.operators.cartesian import _make_derivative
-from parameters import Map_Scenario, Solver, Tracker
-from LHeureux_model import LMAHeureuxPorosityDiff
+from pde import DataTracker, ScipySolver
+# Relative imports when imported as part of the marlpde package, e.g. by the
+# tests, plain imports when run as a script.
+if __package__:
+    from .parameters import Map_Scenario, Solver, Tracker
+    from .LHeureux_model import LMAHeureuxPorosityDiff
+else:
+    from parameters import Map_Scenario, Solver, Tracker
+    from LHeureux_model import LMAHeureuxPorosityDiff
 
-def integrate_equations(**kwargs):
+# The names of the arguments of LMAHeureuxPorosityDiff, to select those from
+# the keyword arguments of integrate_equations. Taken from 
+# https://stackoverflow.com/questions/334655/passing-a-dictionary-to-a-\
+# function-as-keyword-parameters
+_LMA_PARAMETERS = frozenset(p.name for p in 
+                            inspect.signature(LMAHeureuxPorosityDiff).\
+                            parameters.values())
+
+# The integration methods of scipy.integrate.solve_ivp.
+_SOLVE_IVP_METHODS = frozenset(["RK23", "RK45", "DOP853", "Radau", "BDF", 
+                                "LSODA"])
+
+class SnapshotStorage(FileStorage):
     '''
-    This function retrieves the parameters of the Scenario to be simulated and 
-    the solution parameters for the integration. It then integrates the five
-    partial differential equations form L'Heureux, stores and returns the 
-    solution, to be used for plotting.
+    FileStorage that writes every snapshot of the five fields as a single
+    chunk, LZF compressed, instead of gzip compressed, if compression is
+    enabled. Unlike FileStorage, the datasets stay resizable when max_length
+    is given: they are preallocated for max_length snapshots, if the file is
+    kept opened, which avoids resizing them on every write, grow beyond that
+    if needed and are trimmed to the snapshots actually written by 
+    end_writing.
+    '''
+    def _create_hdf_dataset(self, name, shape=tuple(), dtype=np.double):
+        if self.compression:
+            kwargs = {"compression": "lzf", "shuffle": True}
+        else:
+            kwargs = {}
+        # When the file is reopened for every write, the number of snapshots
+        # written is taken from the length of the datasets, so then they
+        # cannot be preallocated.
+        if self._max_length and self.keep_opened:
+            length = self._max_length
+        else:
+            length = 0
+        return self._file.create_dataset(name, shape=(length,) + shape,
+                                         dtype=dtype, maxshape=(None,) + shape,
+                                         chunks=(1,) + shape if shape else True,
+                                         **kwargs)
+
+    def start_writing(self, field, info=None):
+        super().start_writing(field, info=info)
+        if not self.keep_opened and "data_length" in self._file.attrs:
+            # When the file is reopened for every write, FileStorage counts the
+            # snapshots in info, which would be overwritten by a stale count
+            # stored in the file by a previous run.
+            del self._file.attrs["data_length"]
+
+    def end_writing(self):
+        if self._is_writing:
+            if self.keep_opened:
+                # Trim the preallocated datasets to the snapshots written.
+                self._data.resize((self._data_length,) + self.data_shape)
+                self._times.resize((self._data_length,))
+            else:
+                # The file has been closed after the last write. Nothing has
+                # been preallocated and, as explained in start_writing, the
+                # number of snapshots is not stored.
+                self._open("appending")
+                self.info.pop("data_length", None)
+        super().end_writing()
+
+# Repeated calls to integrate_equations with identical settings reuse the
+# numba-compiled right-hand side of the most recently used equations, instead
+# of recompiling it. The points of a parameter sweep differ in their settings,
+# so they do not benefit. The cache is bounded, since every instance holds on
+# to its compiled functions and buffers.
+@lru_cache(maxsize=8)
+def _cached_equation(Number_of_depths, max_depth, ShallowLimit, DeepLimit,
+                     parameters):
+    '''
+    Set up the depth grid and the five partial differential equations from
+    L'Heureux for the parameters of LMAHeureuxPorosityDiff, given as a sorted
+    tuple of (name, value) pairs, such that they can serve as a cache key.
+    '''
+    parameters = dict(parameters)
+    Xstar = parameters["Xstar"]
+
+    depths = CartesianGrid([[0, max_depth/Xstar]], [Number_of_depths], periodic=False)
+
+    # Aragonite dissolution, in coA, only occurs at depths between 
+    # ShallowLimit and DeepLimit, so we need a mask selecting those depths.
+    x = depths.axes_coords[0]
+    dissolution_zone = ((x > ShallowLimit/Xstar) & 
+                        (x < DeepLimit/Xstar)).astype(np.uint8)
+
+    # The equations only take the depth grid from these fields, not their
+    # values, so the initial values need not be part of the cache key.
+    surfaces = [ScalarField(depths) for _ in range(5)]
+
+    return LMAHeureuxPorosityDiff(*surfaces, dissolution_zone, **parameters)
+
+def build_equation(**kwargs):
+    '''
+    Set up the depth grid, the five partial differential equations from 
+    L'Heureux and their initial state for the Scenario given by the keyword
+    arguments. Equations set up recently for the same grid and parameters are 
+    reused. Returns the equations, the initial state and the depth grid.
     '''
 
-    Xstar = kwargs["Xstar"]
-    Tstar = kwargs["Tstar"]
     max_depth = kwargs["max_depth"]
     ShallowLimit = kwargs["ShallowLimit"]
     DeepLimit = kwargs["DeepLimit"]
@@ -32,17 +132,14 @@ def integrate_equations(**kwargs):
     PhiIni = kwargs["PhiIni"]
 
     Number_of_depths = kwargs["N"]
-    # End_time is in units of Tstar.
-    End_time = kwargs["tmax"]/Tstar
-    dt = kwargs["dt"]
 
-    depths = CartesianGrid([[0, max_depth/Xstar]], [Number_of_depths], periodic=False)
-    # We will be needing forward and backward differencing for
-    # Fiadeiro-Veronis differentiation.
-    depths.register_operator("grad_back", \
-        lambda grid: _make_derivative(grid, method="backward"))
-    depths.register_operator("grad_forw", \
-        lambda grid: _make_derivative(grid, method="forward"))
+    # Not all keys from kwargs are LMAHeureuxPorosityDiff arguments.
+    filtered_kwargs = {k: v for k, v in kwargs.items() 
+                       if k in _LMA_PARAMETERS}
+
+    eq = _cached_equation(Number_of_depths, max_depth, ShallowLimit, DeepLimit,
+                          tuple(sorted(filtered_kwargs.items())))
+    depths = eq.AragoniteSurface.grid
     
     AragoniteSurface = ScalarField(depths, CAIni)
     CalciteSurface = ScalarField(depths, CCIni)
@@ -50,34 +147,55 @@ def integrate_equations(**kwargs):
     CO3Surface = ScalarField(depths, cCO3Ini)
     PorSurface = ScalarField(depths, PhiIni)
     
-    # I need those two fields for computing coA, which is rather involved.
-    # There may be a simpler way of selecting these depths, but I haven't
-    # found one yet. For now these two Heaviside step functions.
-    not_too_shallow = ScalarField.from_expression(depths,
-                      f"heaviside(x-{ShallowLimit/Xstar}, 0)")
-    not_too_deep = ScalarField.from_expression(depths,
-                   f"heaviside({DeepLimit/Xstar}-x, 0)")    
-    
-    # Not all keys from kwargs are LMAHeureuxPorosityDiff arguments.
-    # Taken from https://stackoverflow.com/questions/334655/passing-a-\
-    # dictionary-to-a-function-as-keyword-parameters
-    filtered_kwargs = {k: v for k, v in kwargs.items() if k in [p.name for p in 
-                      inspect.signature(LMAHeureuxPorosityDiff).parameters.\
-                        values()]}
-
-    eq = LMAHeureuxPorosityDiff(AragoniteSurface, CalciteSurface, CaSurface, 
-                                CO3Surface, PorSurface, not_too_shallow, 
-                                not_too_deep, **filtered_kwargs)             
-    
     state = eq.get_state(AragoniteSurface, CalciteSurface, CaSurface, 
                          CO3Surface, PorSurface)
+
+    return eq, state, depths
+
+def integrate_equations(**kwargs):
+    '''
+    This function retrieves the parameters of the Scenario to be simulated and 
+    the solution parameters for the integration. It then integrates the five
+    partial differential equations form L'Heureux, stores and returns the 
+    solution, to be used for plotting.
+    '''
+
+    Xstar = kwargs["Xstar"]
+    Tstar = kwargs["Tstar"]
+
+    Number_of_depths = kwargs["N"]
+    # End_time is in units of Tstar.
+    End_time = kwargs["tmax"]/Tstar
+    dt = kwargs["dt"]
+
+    if kwargs["solver"] == "scipy" and \
+       kwargs["scheme"] not in _SOLVE_IVP_METHODS:
+        # Checked before anything is set up or stored. Falling back to the
+        # default method of solve_ivp, RK45, is no option, since it diverges
+        # right away for these stiff equations.
+        raise ValueError(f"Scheme {kwargs['scheme']!r} cannot be used with "
+                         "solver 'scipy', choose one of "
+                         f"{', '.join(sorted(_SOLVE_IVP_METHODS))}.")
+
+    eq, state, depths = build_equation(**kwargs)
     
     # Store your results somewhere in a subdirectory of a parent directory.
+    # The microseconds and the process id keep the subdirectories of
+    # consecutive or parallel integrations apart.
     store_folder = "../Results/" + \
-                   datetime.now().strftime("%d_%m_%Y_%H_%M_%S" + "/")
+                   datetime.now().strftime("%d_%m_%Y_%H_%M_%S_%f") + \
+                   f"_{os.getpid()}/"
     os.makedirs(store_folder)
     stored_results = store_folder + "LMAHeureuxPorosityDiff.hdf5"
-    storage = FileStorage(stored_results, info=kwargs)
+    expected_snapshots = int(np.ceil(End_time / 
+                                     kwargs["progress_tracker_interval"])) + 1
+    storage = SnapshotStorage(stored_results, info=kwargs, 
+                              max_length=expected_snapshots)
+
+    if kwargs.get("progress_bar", True):
+        progress_bar = "progress"
+    else:
+        progress_bar = None
 
     if kwargs["live_plotting"]:
         live_plots = LivePlotTracker(interval=kwargs["plotting_interval"], \
@@ -93,13 +211,40 @@ def integrate_equations(**kwargs):
     else:
         data_tracker = None
     
-    sol, info = eq.solve(state, t_range=End_time, dt=dt, \
-                         solver=kwargs["solver"], scheme=kwargs["scheme"],\
-                         tracker=["progress", \
-                         storage.tracker(kwargs["progress_tracker_interval"]),\
-                         live_plots, data_tracker], \
-                         backend=kwargs["backend"], ret_info=kwargs["retinfo"],\
-                         adaptive=kwargs["adaptive"])
+    if kwargs["solver"] == "scipy":
+        # For scipy.integrate.solve_ivp, the scheme is the integration method,
+        # e.g. a stiff solver like "LSODA", "BDF" or "Radau". The latter two
+        # approximate the Jacobian by finite differences, which is much cheaper
+        # if only the (block tridiagonal) nonzero entries need to be probed.
+        # eq.solve would interpret a "method" keyword argument as the solver,
+        # so it is bound to ScipySolver in advance.
+        scipy_kwargs = {"method": kwargs["scheme"]}
+        if kwargs["scheme"] in ["BDF", "Radau"]:
+            scipy_kwargs["jac_sparsity"] = \
+                eq.jacobian_sparsity(Number_of_depths)
+        solver = partial(ScipySolver, **scipy_kwargs)
+        solver_kwargs = {}
+        # solve_ivp relies on gradual underflow, e.g. for its minimal step size.
+        float_errors = np.errstate(under="ignore")
+    else:
+        solver = kwargs["solver"]
+        solver_kwargs = {"scheme": kwargs["scheme"], 
+                         "adaptive": kwargs["adaptive"]}
+        float_errors = nullcontext()
+
+    # py-pde only finalizes the trackers if the integration ends normally, so
+    # make sure the snapshots stored so far are also kept, and the datasets
+    # trimmed, when the integration fails, e.g. with a FloatingPointError.
+    try:
+        with float_errors:
+            sol, info = eq.solve(state, t_range=End_time, dt=dt, solver=solver, \
+                                 tracker=[progress_bar, \
+                                 storage.tracker(kwargs["progress_tracker_interval"]),\
+                                 live_plots, data_tracker], \
+                                 backend=kwargs["backend"], \
+                                 ret_info=kwargs["retinfo"], **solver_kwargs)
+    finally:
+        storage.end_writing()
 
     print()
     print(f"Meta-information about the solution : {info}")        
@@ -114,6 +259,28 @@ def integrate_equations(**kwargs):
 
     return sol, covered_time_span, depths, Xstar, store_folder
 
+def _integrate_scenario(scenario):
+    return integrate_equations(**scenario)
+
+def _single_threaded_worker():
+    # The parallelism comes from the worker processes, so numba should not
+    # start threads of its own in each of them.
+    numba.set_num_threads(1)
+
+def integrate_scenarios(scenarios, max_workers=None):
+    '''
+    Integrate a number of scenarios in parallel, one per worker process,
+    e.g. for a parameter sweep. Every scenario is a dict with all the keyword
+    arguments for integrate_equations. Returns a list with the output of 
+    integrate_equations for every scenario, in the same order.
+    '''
+    # Forking a process that has already started numba threads can hang the
+    # workers, so start them afresh.
+    with ProcessPoolExecutor(max_workers=max_workers, 
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_single_threaded_worker) as executor:
+        return list(executor.map(_integrate_scenario, scenarios))
+
 def Plot_results(sol, covered_time, depths, Xstar, store_folder):
     '''
     Plot the five fields at the end of the integration interval as a function
@@ -123,7 +290,7 @@ def Plot_results(sol, covered_time, depths, Xstar, store_folder):
     fig.suptitle(f"Distributions after {covered_time:.2f} years")
     # Marker size
     ms = 5
-    plotting_depths = ScalarField.from_expression(depths, "x").data * Xstar
+    plotting_depths = depths.axes_coords[0] * Xstar
     ax.plot(plotting_depths, sol.data[0], "v", ms = ms, label = "CA")
     ax.plot(plotting_depths, sol.data[1], "^", ms = ms, label = "CC")
     ax.plot(plotting_depths, sol.data[2], ">", ms = ms, label = "cCa")
@@ -1,33 +1,45 @@
+from functools import lru_cache
+import math
 import numpy as np
-from pde import FieldCollection, PDEBase, ScalarField
-from numba import njit
+import scipy.sparse as sp
+from pde import FieldCollection, PDEBase
+from numba import njit, prange
 np.seterr(divide="raise", over="raise", under="raise", invalid="raise")
 
+@njit(inline="always", cache=True)
+def sigma_fiadeiro_veronis(Peclet, sign_W, Peclet_min, Peclet_max):
+    ''' Calculate sigma, following formula 8.73 from Boudreau, for a single
+    depth and without branches: coth(P) - 1/P is evaluated at |P| clipped to
+    [Peclet_min, Peclet_max], such that it cannot overflow, and the limits
+    of sigma, 0 and sign(W), are selected outside that interval. P has the
+    sign of W.
+    '''
+    abs_Peclet = min(max(abs(Peclet), Peclet_min), Peclet_max)
+    sigma = sign_W * (1 / np.tanh(abs_Peclet) - 1 / abs_Peclet)
+    sigma = 0. if abs(Peclet) < Peclet_min else sigma
+    return sign_W if abs(Peclet) > Peclet_max else sigma
+
 class LMAHeureuxPorosityDiff(PDEBase):
 
+    # Reuse the compiled right-hand side in subsequent calls to solve. This is
+    # safe, since the parameters of an instance are not changed after
+    # initialisation.
+    cache_rhs = True
+
     def __init__(self, AragoniteSurface, CalciteSurface, CaSurface,
-                CO3Surface, PorSurface, not_too_shallow, not_too_deep, CA0, CC0,
+                CO3Surface, PorSurface, dissolution_zone, CA0, CC0,
                 cCa0, cCO30, Phi0, sedimentationrate, Xstar, Tstar, k1, k2, k3,
                 k4, m1, m2, n1, n2, b, beta, rhos, rhow, rhos0, KA, KC, muA,
                 D0Ca, PhiNR, PhiInfty, PhiIni, DCa, DCO3):
+        # This sets up the cache for the compiled right-hand side, amongst 
+        # other things.
+        super().__init__()
 
         self.AragoniteSurface = AragoniteSurface
         self.CalciteSurface = CalciteSurface
         self.CaSurface = CaSurface
         self.CO3Surface = CO3Surface
         self.PorSurface = PorSurface
-        # There are no bottom boundary conditions for CA and CC in equations 
-        # 35 from L'Heureux, but py-pde demands left and right boundary 
-        # conditions. This means that '"curvature" : 0' is a dummy boundary
-        # condition. We will make sure that it does not leak into our 
-        # integration, by using only backward differencing for the spatial
-        # derivatives in the right-hand sides of the time derivative equations
-        # for CA and CC.
-        self.bc_CA = [{"value": CA0}, {"value" : 1e99}]
-        self.bc_CC = [{"value": CC0}, {"value": 1e99}]
-        self.bc_cCa = [{"value": cCa0}, {"derivative": 0}]
-        self.bc_cCO3 = [{"value": cCO30}, {"derivative": 0}]
-        self.bc_Phi = [{"value": Phi0}, {"derivative": 0}]
         self.sedimentationrate = sedimentationrate
         self.Xstar = Xstar
         self.Tstar = Tstar
@@ -53,11 +65,24 @@ class LMAHeureuxPorosityDiff(PDEBase):
         self.D0Ca = D0Ca
         self.PhiNR = PhiNR
         self.PhiInfty = PhiInfty 
+        self.CA0 = CA0
+        self.CC0 = CC0
+        self.cCa0 = cCa0
+        self.cCO30 = cCO30
         self.Phi0 = Phi0
         self.DCa = DCa
         self.DCO3 = DCO3
-        self.not_too_shallow = not_too_shallow
-        self.not_too_deep = not_too_deep
+        # A uint8 array, one at the depths where aragonite dissolves.
+        self.dissolution_zone = dissolution_zone
+        self.surface_values = np.array([CA0, CC0, cCa0, cCO30, Phi0])
+        # Buffer for the fields extended with the virtual points that 
+        # implement the boundary conditions, reused by every evaluation of 
+        # evolution_rate.
+        self.padded_state = np.empty((len(self.surface_values), 
+                                      dissolution_zone.size + 2))
+        # Buffers for F, U, W and the squared porosity in evolution_rate.
+        self.F_buffer, self.U_buffer, self.W_buffer, \
+            self.Phi_squared_buffer = np.empty((4, dissolution_zone.size))
 
         self.g = 100 * 9.81
         self.dCa = self.DCa / self.D0Ca
@@ -72,7 +97,7 @@ class LMAHeureuxPorosityDiff(PDEBase):
         self.rhorat = (self.rhos / self.rhow - 1) * self.beta / \
                  self.sedimentationrate
         self.presum = 1 - self.rhorat0 * self.Phi0 ** 3 * \
-                 (1 - np.exp(10 - 10 / self.Phi0)) / (1 - self.Phi0)     
+                 (-np.expm1(10 - 10 / self.Phi0)) / (1 - self.Phi0)     
 
         # Fiadeiro-Veronis differentiation involves a coth and a reciprocal, which can
         # easily lead to FloatingPointError: overflow encountered in double_scalars.
@@ -83,15 +108,20 @@ class LMAHeureuxPorosityDiff(PDEBase):
         # Need this number for Fiadeiro-Veronis differentiation.
         self.delta_x = self.AragoniteSurface.grid._axes_coords[0][1] - \
                        self.AragoniteSurface.grid._axes_coords[0][0]
+        # The finite differences multiply by these, instead of dividing by
+        # the grid spacing.
+        self.inv_delta_x = 1 / self.delta_x
+        self.inv_delta_x_squared = self.inv_delta_x ** 2
         self.PhiIni = PhiIni
-        self.F_fixed = 1 - np.exp(10 - 10 / self.PhiIni)
+        self.F_fixed = -np.expm1(10 - 10 / self.PhiIni)
         self.dPhi_fixed = self.auxcon * self.F_fixed *\
                           self.PhiIni ** 3 / (1 - self.PhiIni) 
 
     def get_state(self, AragoniteSurface, CalciteSurface, CaSurface, CO3Surface, 
                   PorSurface):
-        # Return initial state and register forward and backward difference
-        # operators. 
+        # Return initial state. The FieldCollection packs the five fields into
+        # a single contiguous (5, N) array, with the original fields as views
+        # into it, such that the compiled right-hand side sweeps one array.
         AragoniteSurface.label = "ARA"
         CalciteSurface.label = "CAL"
         CaSurface.label = "Ca"
@@ -106,21 +136,59 @@ class LMAHeureuxPorosityDiff(PDEBase):
         # First, extract the porosity at the bottom of the system.
         # The derived quantities will then also be at the bottom of the system.
         Phi = state.data[4][-1]
-        F = 1 - np.exp(10 - 10 / Phi)
+        F = -np.expm1(10 - 10 / Phi)
         one_minus_Phi = 1 - Phi
         U_bottom = self.presum + self.rhorat * Phi ** 3 * F /one_minus_Phi
         return {"U at bottom": U_bottom}
 
     @staticmethod
-    @njit
+    @lru_cache
+    def jacobian_sparsity(no_depths):
+        ''' Sparsity structure of the Jacobian of the right-hand sides, for 
+        implicit solvers from scipy.integrate.solve_ivp, such as "BDF" and
+        "Radau". 
+
+        Parameters
+        ----------
+        no_depths: int
+            Number of depths of the grid.
+
+        Returns
+        -------
+        sparsity: scipy.sparse.csr_matrix(shape=(5 * no_depths, 5 * no_depths))
+            Ones where the Jacobian can be nonzero, following the ordering of
+            the flattened state, i.e. CA, CC, cCa, cCO3 and Phi at all depths.
+            The structure does not depend on the state, so it is built once 
+            for every number of depths; do not modify it.
+        '''
+        # The finite difference stencils couple every depth to its nearest
+        # neighbours. The reaction terms and the Peclet numbers couple all five 
+        # fields at the same depth and, through the gradients and the
+        # Laplacians, also at the neighbouring depths. 
+        # All (row, column) pairs are assembled at once, with the tridiagonal 
+        # pattern of a single block offset by the positions of the fields in 
+        # the flattened state.
+        depth = np.arange(no_depths)
+        block_rows = np.concatenate([depth, depth[1:], depth[:-1]])
+        block_cols = np.concatenate([depth, depth[:-1], depth[1:]])
+        offsets = np.arange(5) * no_depths
+        rows, cols = np.broadcast_arrays(
+            offsets[:, np.newaxis, np.newaxis] + block_rows,
+            offsets[np.newaxis, :, np.newaxis] + block_cols)
+        return sp.csr_matrix((np.ones(rows.size), (rows.ravel(), cols.ravel())),
+                             shape=(5 * no_depths, 5 * no_depths))
+
+    @staticmethod
+    @njit(cache=True)
     def calculate_sigma(Peclet, W_data, Peclet_min, Peclet_max):
         ''' Calculate sigma following formula 8.73 from Boudreau:
         "Diagenetic Models and their implementation"
 
         Parameters
         ----------
-        Peclet: ndarray(dtype=float, ndim=1)
-            Array along depth of the Peclet numbers.
+        Peclet: ndarray(dtype=float, ndim=2)
+            Array along depth of the Peclet numbers, one row per field, 
+            such that the sigmas of all fields are calculated in one pass.
         W-data: ndarray(dtype=float, ndim=1)
             Array along depth of the velocity of the pore water 
             (counted positive downwards)
@@ -131,51 +199,73 @@ class LMAHeureuxPorosityDiff(PDEBase):
 
         Returns
         -------
-        sigma: ndarray(dtype=float, ndim=1)
-            Array along depth with sigma values
+        sigma: ndarray(dtype=float, ndim=2)
+            Array along depth with sigma values, one row per field
         '''
-        sigma = np.empty(Peclet.size)
-        for i in range(sigma.size):
-            if np.abs(Peclet[i]) < Peclet_min:
-                sigma[i] = 0
-            elif np.abs(Peclet[i]) > Peclet_max:
-                sigma[i] = np.sign(W_data[i])
-            else:
-                sigma[i] = np.cosh(Peclet[i])/np.sinh(Peclet[i]) - \
-                    1/Peclet[i]
+        sigma = np.empty_like(Peclet)
+        for i in range(Peclet.shape[1]):
+            sign_W = math.copysign(1., W_data[i])
+            for k in range(Peclet.shape[0]):
+                sigma[k, i] = sigma_fiadeiro_veronis(Peclet[k, i], sign_W,
+                                                     Peclet_min, Peclet_max)
         return sigma
 
     def evolution_rate(self, state, t=0):
-        CA, CC, cCa, cCO3, Phi = state   
+        # Vectorized form of the right-hand sides, on the arrays underlying
+        # the fields, with the boundary conditions implemented by virtual
+        # points. The finite differences are the same as in the numba 
+        # implementation below.
+        CA, CC, cCa, cCO3, Phi = state.data
+        delta_x = self.delta_x
+        inv_delta_x = self.inv_delta_x
+        inv_delta_x_squared = self.inv_delta_x_squared
+
+        # Extend the fields with a virtual point above the surface, 
+        # implementing the Dirichlet boundary conditions, and a virtual point
+        # below the bottom, implementing a zero derivative. 
+        padded = self.padded_state
+        padded[:, 1:-1] = state.data
+        padded[:, 0] = 2 * self.surface_values - state.data[:, 0]
+        padded[:, -1] = state.data[:, -1]
+        CA_padded, CC_padded, cCa_padded, cCO3_padded, Phi_padded = padded
 
         two_factors = cCa * cCO3
-        two_factors_upp_lim = two_factors.to_scalar(lambda f: np.fmin(f,1))
-        two_factors_low_lim = two_factors.to_scalar(lambda f: np.fmax(f,1))
+        two_factors_upp_lim = np.fmin(two_factors, 1)
+        two_factors_low_lim = np.fmax(two_factors, 1)
 
         three_factors = two_factors * self.KRat
-        three_factors_upp_lim = three_factors.to_scalar(lambda f: np.fmin(f,1))
-        three_factors_low_lim = three_factors.to_scalar(lambda f: np.fmax(f,1))
+        three_factors_upp_lim = np.fmin(three_factors, 1)
+        three_factors_low_lim = np.fmax(three_factors, 1)
 
         coA = CA * (((1 - three_factors_upp_lim) ** self.m2) * \
-                    (self.not_too_deep * self.not_too_shallow) - self.nu1 * \
+                    self.dissolution_zone - self.nu1 * \
                     (three_factors_low_lim - 1) ** self.m1)
  
         coC = CC * (((two_factors_low_lim - 1) ** self.n1) - self.nu2 * \
                     (1 - two_factors_upp_lim) ** self.n2)
 
-        F = 1 - np.exp(10 - 10 / Phi)
+        # F, U and W are computed in place, in buffers of the instance.
+        inv_Phi = 1 / Phi
+        F = np.multiply(-10, inv_Phi, out=self.F_buffer)
+        F += 10
+        np.expm1(F, out=F)
+        np.negative(F, out=F)
         one_minus_Phi = 1 - Phi
-        U = self.presum + self.rhorat * Phi ** 3 * F /one_minus_Phi
+        Phi_squared = np.multiply(Phi, Phi, out=self.Phi_squared_buffer)
+        U = np.multiply(Phi_squared, Phi, out=self.U_buffer)
+        U *= F
+        U /= one_minus_Phi
+        U *= self.rhorat
+        U += self.presum
 
         # Enforce no bottom boundary condition for CA and CC by using
         # backwards differencing only.
-        CA_grad_back = CA.apply_operator("grad_back", self.bc_CA)
-        CA_grad = CA_grad_back
-
-        CC_grad_back = CC.apply_operator("grad_back", self.bc_CC)
-        CC_grad = CC_grad_back
+        CA_grad = (CA - CA_padded[:-2]) * inv_delta_x
+        CC_grad = (CC - CC_padded[:-2]) * inv_delta_x
 
-        W = self.presum - self.rhorat * Phi ** 2 * F
+        W = np.multiply(Phi_squared, F, out=self.W_buffer)
+        W *= -self.rhorat
+        W += self.presum
         
         dCA_dt = - U * CA_grad - self.Da * ((1 - CA) \
                  * coA + self.lambda_ * CA * coC)
@@ -188,62 +278,73 @@ class LMAHeureuxPorosityDiff(PDEBase):
 
         # Fiadeiro-Veronis scheme for equations 42 and 43
         # from l'Heureux. 
-        common_Peclet  = W * self.delta_x / 2. 
-        Peclet_cCa =  common_Peclet * denominator/ self.dCa       
-        sigma_cCa_data = LMAHeureuxPorosityDiff.calculate_sigma(\
-            Peclet_cCa.data, W.data, self.Peclet_min, self.Peclet_max)
-        sigma_cCa = ScalarField(state.grid, sigma_cCa_data)
-
-        Peclet_cCO3 = common_Peclet * denominator/ self.dCO3      
-        sigma_cCO3_data = LMAHeureuxPorosityDiff.calculate_sigma(\
-            Peclet_cCO3.data, W.data, self.Peclet_min, self.Peclet_max)
-        sigma_cCO3 = ScalarField(state.grid, sigma_cCO3_data)
+        common_Peclet  = W * delta_x / 2. 
 
         # dPhi = self.auxcon * F * (Phi ** 3) / one_minus_Phi
         dPhi = self.dPhi_fixed
 
-        Peclet_Phi = common_Peclet / dPhi
-        sigma_Phi_data = LMAHeureuxPorosityDiff.calculate_sigma(\
-            Peclet_Phi.data, W.data, self.Peclet_min, self.Peclet_max)
-        sigma_Phi = ScalarField(state.grid, sigma_Phi_data)
+        Peclet = np.stack([common_Peclet * denominator / self.dCa,
+                           common_Peclet * denominator / self.dCO3,
+                           common_Peclet / dPhi])
+        sigma_cCa, sigma_cCO3, sigma_Phi = \
+            LMAHeureuxPorosityDiff.calculate_sigma(Peclet, W, self.Peclet_min,
+                                                   self.Peclet_max)
 
-        cCa_grad_back = cCa.apply_operator("grad_back", self.bc_cCa)
-        cCa_grad_forw = cCa.apply_operator("grad_forw", self.bc_cCa)
+        cCa_grad_back = (cCa - cCa_padded[:-2]) * inv_delta_x
+        cCa_grad_forw = (cCa_padded[2:] - cCa) * inv_delta_x
         cCa_grad = 0.5 * ((1-sigma_cCa) * cCa_grad_forw +\
              (1+sigma_cCa) * cCa_grad_back)
+        cCa_laplace = (cCa_padded[2:] - 2 * cCa + cCa_padded[:-2]) * \
+                      inv_delta_x_squared
 
-        cCO3_grad_back = cCO3.apply_operator("grad_back", self.bc_cCO3)
-        cCO3_grad_forw = cCO3.apply_operator("grad_forw", self.bc_cCO3)
+        cCO3_grad_back = (cCO3 - cCO3_padded[:-2]) * inv_delta_x
+        cCO3_grad_forw = (cCO3_padded[2:] - cCO3) * inv_delta_x
         cCO3_grad = 0.5 * ((1-sigma_cCO3) * cCO3_grad_forw +\
              (1+sigma_cCO3) * cCO3_grad_back)
+        cCO3_laplace = (cCO3_padded[2:] - 2 * cCO3 + cCO3_padded[:-2]) * \
+                       inv_delta_x_squared
 
-        Phi_grad_back = Phi.apply_operator("grad_back", self.bc_Phi)
-        Phi_grad_forw = Phi.apply_operator("grad_forw", self.bc_Phi)
+        Phi_grad_back = (Phi - Phi_padded[:-2]) * inv_delta_x
+        Phi_grad_forw = (Phi_padded[2:] - Phi) * inv_delta_x
         Phi_grad = 0.5 * ((1-sigma_Phi) * Phi_grad_forw +\
              (1+sigma_Phi) * Phi_grad_back)
+        Phi_laplace = (Phi_padded[2:] - 2 * Phi + Phi_padded[:-2]) * \
+                      inv_delta_x_squared
 
         Phi_denom = Phi/denominator
-        grad_Phi_denom = Phi_grad * (denominator + 2) / denominator ** 2
+        grad_Phi_denom = Phi_grad * (denominator + 2) / \
+                         (denominator * denominator)
 
         common_helper = coA - self.lambda_ * coC
 
-        dcCa_dt = (cCa_grad * grad_Phi_denom + Phi_denom * cCa.laplace(self.bc_cCa)) \
-                  * self.dCa /Phi -W * cCa_grad \
-                  + self.Da * one_minus_Phi * (self.delta - cCa) * common_helper / Phi
+        dcCa_dt = (cCa_grad * grad_Phi_denom + Phi_denom * cCa_laplace) \
+                  * self.dCa * inv_Phi -W * cCa_grad \
+                  + self.Da * one_minus_Phi * (self.delta - cCa) * common_helper \
+                  * inv_Phi
 
-        dcCO3_dt = (cCO3_grad * grad_Phi_denom + Phi_denom * cCO3.laplace(self.bc_cCO3)) \
-                   * self.dCO3/Phi -W * cCO3_grad \
-                   + self.Da * one_minus_Phi * (self.delta - cCO3) * common_helper / Phi
+        dcCO3_dt = (cCO3_grad * grad_Phi_denom + Phi_denom * cCO3_laplace) \
+                   * self.dCO3 * inv_Phi -W * cCO3_grad \
+                   + self.Da * one_minus_Phi * (self.delta - cCO3) * common_helper \
+                   * inv_Phi
 
         dW_dx = -self.rhorat * Phi_grad * (2 * Phi * F + 10 * (F - 1))
 
         # This is closer to the original form of (43) from l' Heureux than
         # the Matlab implementation.
         dPhi_dt = - (Phi * dW_dx + W * Phi_grad) \
-                  + dPhi * Phi.laplace(self.bc_Phi) \
+                  + dPhi * Phi_laplace \
                   + self.Da * one_minus_Phi * common_helper
 
-        return FieldCollection([dCA_dt, dCC_dt, dcCa_dt, dcCO3_dt, dPhi_dt])
+        # The rates are written straight into the rows of a new collection,
+        # without stacking them first. This cannot be a buffer shared between
+        # calls, since the stepper keeps the rates of earlier stages.
+        rate = state.copy()
+        rate.data[0] = dCA_dt
+        rate.data[1] = dCC_dt
+        rate.data[2] = dcCa_dt
+        rate.data[3] = dcCO3_dt
+        rate.data[4] = dPhi_dt
+        return rate
 
     def _make_pde_rhs_numba(self, state):
         """ the numba-accelerated evolution equation """
@@ -255,8 +356,7 @@ class LMAHeureuxPorosityDiff(PDEBase):
         n2 = self.n2
         nu1 = self.nu1
         nu2 = self.nu2
-        not_too_deep = self.not_too_deep.data
-        not_too_shallow = self.not_too_shallow.data
+        dissolution_zone = self.dissolution_zone
         presum = self.presum
         rhorat= self.rhorat
         lambda_ = self.lambda_
@@ -268,184 +368,183 @@ class LMAHeureuxPorosityDiff(PDEBase):
         dPhi_fixed = self.dPhi_fixed
         Peclet_min = self.Peclet_min
         Peclet_max = self.Peclet_max
+        # The Peclet numbers are multiplied by these, instead of divided by 
+        # the diffusion coefficients.
+        inv_dCa = 1 / dCa
+        inv_dCO3 = 1 / dCO3
+        inv_dPhi = 1 / dPhi_fixed
         delta_x = state.grid._axes_coords[0][1] - state.grid._axes_coords[0][0]
-
-        # Enforce no bottom boundary condition for CA and CC by using
-        # backwards differencing only.
-        grad_back_CA = state.grid.make_operator("grad_back", bc = self.bc_CA)
-        grad_back_CC = state.grid.make_operator("grad_back", bc = self.bc_CC)
-        grad_back_cCa = state.grid.make_operator("grad_back", bc = self.bc_cCa)
-        grad_forw_cCa = state.grid.make_operator("grad_forw", bc = self.bc_cCa)
-        laplace_cCa = state.grid.make_operator("laplace", bc = self.bc_cCa)
-        grad_back_cCO3 = state.grid.make_operator("grad_back", bc = self.bc_cCO3)
-        grad_forw_cCO3 = state.grid.make_operator("grad_forw", bc = self.bc_cCO3)
-        laplace_cCO3 = state.grid.make_operator("laplace", bc = self.bc_cCO3)
-        grad_back_Phi = state.grid.make_operator("grad_back", bc = self.bc_Phi)
-        grad_forw_Phi = state.grid.make_operator("grad_forw", bc = self.bc_Phi)
-        laplace_Phi = state.grid.make_operator("laplace", bc = self.bc_Phi)
-
-        @njit
+        inv_delta_x = 1 / delta_x
+        inv_delta_x_squared = inv_delta_x * inv_delta_x
+
+        no_depths = state.grid.shape[0]
+        # Surface values of the fields, i.e. the Dirichlet boundary conditions.
+        CA0 = self.CA0
+        CC0 = self.CC0
+        cCa0 = self.cCa0
+        cCO30 = self.cCO30
+        Phi0 = self.Phi0
+
+        # numba freezes the variables from this closure, i.e. all parameters
+        # above, as compile-time constants, such that LLVM can fold them.
+        # With cache=True, the compiled function is stored on disk, keyed by
+        # these constants, so only a later run with identical parameters skips
+        # compilation. Every point of a parameter sweep misses the cache and
+        # adds a file of about 100 kB to __pycache__, which is never evicted.
+        @njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
         def pde_rhs(state_data, t=0):
             """ compiled helper function evaluating right hand side """
-            # Instead of the default central differenced gradient from py-pde
-            # construct forward and backward differenced gradients and apply
-            # either one of them, based on the sign of U.
+            # All finite differences are computed in the same loop over depths
+            # as the right-hand sides, such that the neighbours of every depth
+            # are loaded only once.
             CA = state_data[0]
-            CA_grad_back = grad_back_CA(CA)
-
             CC = state_data[1]
-            CC_grad_back = grad_back_CC(CC)
-
             cCa = state_data[2]
-            cCa_grad_back = grad_back_cCa(cCa)
-            cCa_grad_forw = grad_forw_cCa(cCa)
-            cCa_laplace = laplace_cCa(cCa)
-
             cCO3 = state_data[3]
-            cCO3_grad_back = grad_back_cCO3(cCO3)
-            cCO3_grad_forw = grad_forw_cCO3(cCO3)
-            cCO3_laplace = laplace_cCO3(cCO3)
-
             Phi = state_data[4]
-            Phi_grad_back = grad_back_Phi(Phi)
-            Phi_grad_forw = grad_forw_Phi(Phi)
-            Phi_laplace = laplace_Phi(Phi)
 
+            # All intermediate quantities are scalars local to an iteration
+            # of the loop over depths, so the only arrays allocated per call 
+            # are the rates and the halo copy of the state.
             rate = np.empty_like(state_data)
 
-            # state_data.size should be the same as len(CA) or len(CC), check this.
-            # So the number of depths, really.
-            no_depths = state_data[0].size
-
-            denominator = np.empty(no_depths)
-            common_helper1 = np.empty(no_depths)
-            common_helper2 = np.empty(no_depths)
-            helper_cCa_grad = np.empty(no_depths)
-            helper_cCO3_grad = np.empty(no_depths)
-            F = np.empty(no_depths)
-            U = np.empty(no_depths)
-            W = np.empty(no_depths)
-            two_factors = np.empty(no_depths)
-            two_factors_upp_lim = np.empty(no_depths)
-            two_factors_low_lim = np.empty(no_depths)
-            three_factors = np.empty(no_depths)
-            three_factors_upp_lim = np.empty(no_depths)
-            three_factors_low_lim = np.empty(no_depths)
-            coA = np.empty(no_depths)
-            coC = np.empty(no_depths)
-            common_helper3 = np.empty(no_depths)
-            dPhi = np.empty(no_depths)
-            dW_dx = np.empty(no_depths)
-            one_minus_Phi = np.empty(no_depths)
-            CA_grad = np.empty(no_depths)
-            CC_grad = np.empty(no_depths)
-            cCa_grad = np.empty(no_depths)
-            cCO3_grad = np.empty(no_depths)
-            Phi_grad = np.empty(no_depths)            
-
-            for i in range(no_depths):
-                F[i] = 1 - np.exp(10 - 10 / Phi[i])
-
-                U[i] = presum + rhorat * Phi[i] ** 3 * F[i]/ (1 - Phi[i])
+            # Values at the neighbouring depths are taken from a copy of the 
+            # state with a halo of virtual points: above the surface, these 
+            # implement the Dirichlet boundary conditions, below the bottom a 
+            # zero derivative for cCa, cCO3 and Phi. CA and CC need no bottom 
+            # values, since only backward differences are used for them. 
+            # This keeps the loop below free of branches for the boundaries.
+            padded = np.empty((state_data.shape[0], no_depths + 2))
+            padded[:, 1:-1] = state_data
+            padded[:, -1] = state_data[:, -1]
+            padded[0, 0] = 2 * CA0 - CA[0]
+            padded[1, 0] = 2 * CC0 - CC[0]
+            padded[2, 0] = 2 * cCa0 - cCa[0]
+            padded[3, 0] = 2 * cCO30 - cCO3[0]
+            padded[4, 0] = 2 * Phi0 - Phi[0]
+
+            for i in prange(no_depths):
+                CA_above = padded[0, i]
+                CC_above = padded[1, i]
+                cCa_above = padded[2, i]
+                cCO3_above = padded[3, i]
+                Phi_above = padded[4, i]
+                cCa_below = padded[2, i + 2]
+                cCO3_below = padded[3, i + 2]
+                Phi_below = padded[4, i + 2]
+
+                CA_grad_back = (CA[i] - CA_above) * inv_delta_x
+                CC_grad_back = (CC[i] - CC_above) * inv_delta_x
+                cCa_grad_back = (cCa[i] - cCa_above) * inv_delta_x
+                cCa_grad_forw = (cCa_below - cCa[i]) * inv_delta_x
+                cCa_laplace = (cCa_below - 2 * cCa[i] + cCa_above) * \
+                              inv_delta_x_squared
+                cCO3_grad_back = (cCO3[i] - cCO3_above) * inv_delta_x
+                cCO3_grad_forw = (cCO3_below - cCO3[i]) * inv_delta_x
+                cCO3_laplace = (cCO3_below - 2 * cCO3[i] + cCO3_above) * \
+                               inv_delta_x_squared
+                Phi_grad_back = (Phi[i] - Phi_above) * inv_delta_x
+                Phi_grad_forw = (Phi_below - Phi[i]) * inv_delta_x
+                Phi_laplace = (Phi_below - 2 * Phi[i] + Phi_above) * \
+                              inv_delta_x_squared
+
+                # Divisions by the porosity and by the denominator below are
+                # multiplications by their reciprocals.
+                inv_Phi = 1 / Phi[i]
+                one_minus_Phi = 1 - Phi[i]
+
+                # expm1 avoids cancellation for Phi close to 1.
+                F = -math.expm1(10 - 10 * inv_Phi)
+
+                Phi_squared = Phi[i] * Phi[i]
+                U = presum + rhorat * Phi_squared * Phi[i] * F / one_minus_Phi
 
                 # Enforce no bottom boundary condition for CA and CC by using
                 # backwards differencing only.
-                CA_grad[i] = CA_grad_back[i]
-                CC_grad[i] = CC_grad_back[i]
+                CA_grad = CA_grad_back
+                CC_grad = CC_grad_back
 
-                W[i] = presum - rhorat * Phi[i] ** 2 * F[i]
+                W = presum - rhorat * Phi_squared * F
 
                 # Implementing equation 6 from l'Heureux.
-                denominator[i] = 1 - 2 * np.log(Phi[i])
+                denominator = 1 - 2 * np.log(Phi[i])
+                inv_denominator = 1 / denominator
 
                 # Fiadeiro-Veronis scheme for equations 42 and 43
-                # from l'Heureux. 
-                Peclet_cCa = W[i] * delta_x * denominator[i]/ (2. * dCa )
-                if np.abs(Peclet_cCa) < Peclet_min:
-                    sigma_cCa = 0
-                elif np.abs(Peclet_cCa) > Peclet_max:
-                    sigma_cCa = np.sign(W[i])
-                else:
-                     sigma_cCa = np.cosh(Peclet_cCa)/np.sinh(Peclet_cCa) - \
-                        1/Peclet_cCa
-
-                Peclet_cCO3 = W[i] * delta_x * denominator[i]/ (2. * dCO3)
-                if np.abs(Peclet_cCO3) < Peclet_min:
-                    sigma_cCO3 = 0
-                elif np.abs(Peclet_cCO3) > Peclet_max:
-                    sigma_cCO3 = np.sign(W[i])
-                else:
-                    sigma_cCO3 = np.cosh(Peclet_cCO3)/np.sinh(Peclet_cCO3) - \
-                        1/Peclet_cCO3
-
-                one_minus_Phi[i] = 1 - Phi[i]                 
-                dPhi[i] = dPhi_fixed
-                Peclet_Phi = W[i] * delta_x / (2. * dPhi[i])
-                if np.abs(Peclet_Phi) < Peclet_min:
-                    sigma_Phi = 0
-                elif np.abs(Peclet_Phi) > Peclet_max:
-                    sigma_Phi = np.sign(W[i])
-                else:
-                    sigma_Phi = np.cosh(Peclet_Phi)/np.sinh(Peclet_Phi) - \
-                        1/Peclet_Phi
-
-                cCa_grad[i] = 0.5 * ((1-sigma_cCa) * cCa_grad_forw[i] + \
-                              (1+sigma_cCa) * cCa_grad_back[i])
-                cCO3_grad[i] = 0.5 * ((1-sigma_cCO3) * cCO3_grad_forw[i] + \
-                              (1+sigma_cCO3) * cCO3_grad_back[i])
-                Phi_grad[i] = 0.5 * ((1-sigma_Phi) * Phi_grad_forw [i]+ \
-                              (1+sigma_Phi) * Phi_grad_back[i])
-
-                common_helper1[i] = Phi[i]/denominator[i]
-                common_helper2[i] = Phi_grad[i] * (2 + denominator[i]) \
-                                    / denominator[i] ** 2
-                helper_cCa_grad[i] = dCa * (common_helper2[i] * cCa_grad[i] \
-                                     + common_helper1[i] * cCa_laplace[i])
-                helper_cCO3_grad[i] = dCO3 * (common_helper2[i] * cCO3_grad[i] \
-                                     + common_helper1[i] * cCO3_laplace[i])            
-
-                two_factors[i] = cCa[i] * cCO3[i]
-                two_factors_upp_lim[i] = min(two_factors[i],1)
-                two_factors_low_lim[i] = max(two_factors[i],1)
-                three_factors[i] = two_factors[i] * KRat
-                three_factors_upp_lim[i] = min(three_factors[i],1)
-                three_factors_low_lim[i] = max(three_factors[i],1)
-
-                coA[i] = CA[i] * (((1 - three_factors_upp_lim[i]) ** m2) * \
-                    (not_too_deep[i] * not_too_shallow[i]) - nu1 * \
-                    (three_factors_low_lim[i] - 1) ** m1)
-
-                coC[i] = CC[i] * (((two_factors_low_lim[i] - 1) ** n1) - nu2 * \
-                    (1 - two_factors_upp_lim[i]) ** n2)         
-
-                common_helper3[i] = coA[i] - lambda_* coC[i]
+                # from l'Heureux. The three Peclet numbers only differ by 
+                # their diffusion coefficients.
+                sign_W = math.copysign(1., W)
+                common_Peclet = W * delta_x * 0.5
+                sigma_cCa = sigma_fiadeiro_veronis(common_Peclet * denominator
+                                                   * inv_dCa, sign_W,
+                                                   Peclet_min, Peclet_max)
+                sigma_cCO3 = sigma_fiadeiro_veronis(common_Peclet * 
+                                                    denominator * inv_dCO3,
+                                                    sign_W, Peclet_min,
+                                                    Peclet_max)
+
+                dPhi = dPhi_fixed
+                sigma_Phi = sigma_fiadeiro_veronis(common_Peclet * inv_dPhi,
+                                                   sign_W, Peclet_min, 
+                                                   Peclet_max)
+
+                cCa_grad = 0.5 * ((1-sigma_cCa) * cCa_grad_forw + \
+                           (1+sigma_cCa) * cCa_grad_back)
+                cCO3_grad = 0.5 * ((1-sigma_cCO3) * cCO3_grad_forw + \
+                            (1+sigma_cCO3) * cCO3_grad_back)
+                Phi_grad = 0.5 * ((1-sigma_Phi) * Phi_grad_forw + \
+                           (1+sigma_Phi) * Phi_grad_back)
+
+                common_helper1 = Phi[i] * inv_denominator
+                common_helper2 = Phi_grad * (2 + denominator) * \
+                                 inv_denominator * inv_denominator
+                helper_cCa_grad = dCa * (common_helper2 * cCa_grad \
+                                  + common_helper1 * cCa_laplace)
+                helper_cCO3_grad = dCO3 * (common_helper2 * cCO3_grad \
+                                   + common_helper1 * cCO3_laplace)
+
+                two_factors = cCa[i] * cCO3[i]
+                two_factors_upp_lim = min(two_factors,1)
+                two_factors_low_lim = max(two_factors,1)
+                three_factors = two_factors * KRat
+                three_factors_upp_lim = min(three_factors,1)
+                three_factors_low_lim = max(three_factors,1)
+
+                # Aragonite only dissolves in the dissolution zone.
+                coA = - nu1 * (three_factors_low_lim - 1) ** m1
+                if dissolution_zone[i]:
+                    coA += (1 - three_factors_upp_lim) ** m2
+                coA *= CA[i]
+
+                coC = CC[i] * (((two_factors_low_lim - 1) ** n1) - nu2 * \
+                    (1 - two_factors_upp_lim) ** n2)         
+
+                common_helper3 = coA - lambda_* coC
                    
-                dW_dx[i] = -rhorat * Phi_grad[i] * (2 * Phi[i] * F[i] + 10 * (F[i] - 1))    
+                dW_dx = -rhorat * Phi_grad * (2 * Phi[i] * F + 10 * (F - 1))    
        
                 # This is dCA_dt
-                rate[0][i] = - U[i] * CA_grad[i] - Da * ((1 - CA[i]) \
-                             * coA[i] + lambda_ * CA[i] * coC[i])
+                rate[0, i] = - U * CA_grad - Da * ((1 - CA[i]) \
+                             * coA + lambda_ * CA[i] * coC)
 
                 # This is dCC_dt
-                rate[1][i] = - U[i] * CC_grad[i] + Da * (lambda_ * \
-                             (1 - CC[i]) * coC[i] + CC[i] * coA[i])              
+                rate[1, i] = - U * CC_grad + Da * (lambda_ * \
+                             (1 - CC[i]) * coC + CC[i] * coA)              
 
                 # This is dcCa_dt
-                rate[2][i] =  helper_cCa_grad[i]/Phi[i] - W[i] * \
-                              cCa_grad[i] + Da * one_minus_Phi[i] * \
-                              (delta - cCa[i]) * common_helper3[i] \
-                              /Phi[i]                                 
+                rate[2, i] =  helper_cCa_grad * inv_Phi - W * \
+                              cCa_grad + Da * one_minus_Phi * \
+                              (delta - cCa[i]) * common_helper3 * inv_Phi
 
                 # This is dcCO3_dt
-                rate[3][i] =  helper_cCO3_grad[i]/Phi[i] - W[i] * \
-                              cCO3_grad[i] + Da * one_minus_Phi[i] * \
-                              (delta - cCO3[i]) * common_helper3[i] \
-                              /Phi[i]                       
+                rate[3, i] =  helper_cCO3_grad * inv_Phi - W * \
+                              cCO3_grad + Da * one_minus_Phi * \
+                              (delta - cCO3[i]) * common_helper3 * inv_Phi
 
                 # This is dPhi_dt
-                rate[4][i] = - (dW_dx[i] * Phi[i] + W[i] * Phi_grad[i]) \
-                             + dPhi[i] * Phi_laplace[i] + Da * one_minus_Phi[i] \
-                             * common_helper3[i] 
+                rate[4, i] = - (dW_dx * Phi[i] + W * Phi_grad) \
+                             + dPhi * Phi_laplace + Da * one_minus_Phi \
+                             * common_helper3 
 
             return rate
 
@@ -1,2 +0,0 @@
-import pathlib, sys
-sys.path.append(str(pathlib.Path(__file__).parent))
@@ -160,6 +160,8 @@ class Solver:
     tmax: float     = Map_Scenario().Tstar
     # timesteps in between writing.
     N: int        = 200
+    # Use solver = "scipy" with scheme = "LSODA", "BDF" or "Radau" for
+    # stiff integrations with scipy.integrate.solve_ivp.
     solver: str   = "explicit"
     scheme: str   = "rk"
     backend: str = "numba"
@@ -173,6 +175,9 @@ class Tracker:
     Also indicates the quantities to be tracked, as boolean values.
     '''
     progress_tracker_interval: float = 0.01
+    # The progress bar interrupts the integration about every second of wall
+    # clock time; switch it off for benchmarking.
+    progress_bar: bool = True
     live_plotting: bool = False
     plotting_interval: str = '0:05'
     data_tracker_interval: float = 0.01
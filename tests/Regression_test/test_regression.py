@@ -2,7 +2,6 @@ from dataclasses import asdict, replace
 import numpy as np
 import h5py
 from numpy.testing import assert_allclose
-from pde import CartesianGrid, ScalarField
 from marlpde.parameters import Map_Scenario, Solver, Tracker
 from marlpde.Evolve_scenario import integrate_equations
 
@@ -114,20 +113,15 @@ def test_cross_check_with_Matlab_output():
                                     "k3": 0.01, "k4": 0.01}
     Xstar =  Scenario_parameters["Xstar"]
 
-    max_depth = Scenario_parameters["max_depth"]  
-
     all_kwargs = Scenario_parameters  | asdict(Solver()) | asdict(Tracker())
     
-    solution, _, _, _, _ = integrate_equations(**all_kwargs)
+    solution, _, depths, _, _ = integrate_equations(**all_kwargs)
 
     Number_of_depths = all_kwargs["N"]
 
-    # It may seem a bit cumbersome to arrive at Python_plotting_depths in this manner,
-    # but we are trying to mimick the way the grid has been setup in Evolve_scenario.py.
-    Python_depth_grid = CartesianGrid([[0, max_depth/Xstar]], [Number_of_depths], \
-                           periodic=False)
-    
-    Python_plotting_depths = ScalarField.from_expression(Python_depth_grid, "x").data * Xstar
+    # Take the depths from the grid that was used for the integration, in the
+    # same way as Plot_results in Evolve_scenario.py does.
+    Python_plotting_depths = depths.axes_coords[0] * Xstar
 
     # Now we need to interpolate the Matlab field values CA, CC, cCa, cCO3 and Phi to
     # the Python grid values.
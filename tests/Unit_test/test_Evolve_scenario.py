@@ -0,0 +1,116 @@
+from dataclasses import asdict
+import os
+import pytest
+import numpy as np
+import h5py
+from numpy.testing import assert_allclose
+from pde import CartesianGrid, ScalarField, FieldCollection
+from marlpde.parameters import Map_Scenario, Solver, Tracker
+from marlpde.Evolve_scenario import integrate_equations, integrate_scenarios, \
+                                    SnapshotStorage
+
+def test_BDF_integration():
+    '''
+    A short integration with the stiff BDF solver from scipy, using the
+    sparsity pattern of the Jacobian, should store one finite snapshot of all
+    five fields per tracker interval and end close to the result of the 
+    default explicit solver. Few depths and a short integration time keep this
+    quick.
+    '''
+    atol = 5e-3
+
+    Scenario_parameters = asdict(Map_Scenario())
+    all_kwargs = Scenario_parameters | asdict(Solver()) | \
+                 asdict(Tracker()) | \
+                 {"N": 40, "tmax": 0.02 * Scenario_parameters["Tstar"],
+                  "progress_bar": False}
+
+    explicit_solution, _, _, _, _ = integrate_equations(**all_kwargs)
+    BDF_solution, _, _, _, store_folder = \
+        integrate_equations(**(all_kwargs | {"solver": "scipy", 
+                                             "scheme": "BDF"}))
+
+    # Preallocated snapshots that were never written should have been trimmed.
+    expected_snapshots = int(np.ceil(all_kwargs["tmax"] / 
+                                     all_kwargs["Tstar"] /
+                                     all_kwargs["progress_tracker_interval"])) \
+                         + 1
+    with h5py.File(store_folder + "LMAHeureuxPorosityDiff.hdf5", 'r') as hf:
+        snapshots = hf["data"][:]
+        assert len(hf["data"]) == len(hf["times"]) == expected_snapshots
+
+    assert snapshots.shape[1:] == (5, 40)
+    assert np.all(np.isfinite(snapshots))
+    assert_allclose(BDF_solution.data, explicit_solution.data, atol=atol)
+
+def test_scipy_solver_with_explicit_scheme():
+    '''
+    The default scheme, "rk", is meant for the explicit solver. Combined with
+    solver="scipy" it should be rejected with an error naming the schemes
+    that solve_ivp does accept.
+    '''
+    all_kwargs = asdict(Map_Scenario()) | asdict(Solver()) | \
+                 asdict(Tracker()) | {"solver": "scipy"}
+
+    with pytest.raises(ValueError, match="BDF"):
+        integrate_equations(**all_kwargs)
+
+def test_integrate_scenarios():
+    '''
+    Two scenarios integrated in parallel, over a short time, should each 
+    store their results in a folder of their own.
+    '''
+    Scenario_parameters = asdict(Map_Scenario())
+    all_kwargs = Scenario_parameters | asdict(Solver()) | \
+                 asdict(Tracker()) | \
+                 {"N": 40, "tmax": 0.001 * Scenario_parameters["Tstar"],
+                  "progress_bar": False}
+    scenarios = [all_kwargs, all_kwargs | {"PhiIni": 0.6}]
+
+    results = integrate_scenarios(scenarios, max_workers=2)
+
+    store_folders = [store_folder for _, _, _, _, store_folder in results]
+    assert len(set(store_folders)) == 2
+    for store_folder in store_folders:
+        assert os.path.isdir(store_folder)
+
+@pytest.mark.parametrize("keep_opened", [True, False])
+@pytest.mark.parametrize("number_of_snapshots", [2, 6])
+def test_SnapshotStorage(tmp_path, keep_opened, number_of_snapshots):
+    '''
+    SnapshotStorage relies on internals of FileStorage from py-pde, so check
+    that it stores exactly the snapshots written, fewer or more than 
+    max_length, both when the file is kept opened and when it is reopened for
+    every write, and that more snapshots can be appended afterwards.
+    '''
+    Number_of_depths = 10
+    max_length = 4
+    number_of_appended_snapshots = 3
+
+    depths = CartesianGrid([[0, 1]], [Number_of_depths], periodic=False)
+    state = FieldCollection([ScalarField(depths, value) 
+                             for value in range(5)])
+    stored_results = str(tmp_path / "LMAHeureuxPorosityDiff.hdf5")
+
+    times = np.arange(number_of_snapshots + number_of_appended_snapshots)
+    for write_mode, stored_times in [
+        ("truncate_once", times[:number_of_snapshots]),
+        ("append", times)]:
+        storage = SnapshotStorage(stored_results, max_length=max_length,
+                                  write_mode=write_mode, 
+                                  keep_opened=keep_opened)
+        storage.start_writing(state)
+        for time in stored_times[len(storage):]:
+            storage.append(state, time)
+        storage.end_writing()
+
+        with h5py.File(stored_results, 'r') as hf:
+            assert hf["data"].shape == (len(stored_times), 5, 
+                                        Number_of_depths)
+            assert hf["data"].chunks == (1, 5, Number_of_depths)
+            assert hf["data"].compression == "lzf"
+            assert_allclose(hf["times"][:], stored_times)
+            assert_allclose(hf["data"][-1], state.data)
+
+        assert len(SnapshotStorage(stored_results, write_mode="readonly")) \
+               == len(stored_times)
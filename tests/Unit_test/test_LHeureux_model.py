@@ -0,0 +1,50 @@
+from dataclasses import asdict
+import numpy as np
+from marlpde.parameters import Map_Scenario, Solver, Tracker
+from marlpde.LHeureux_model import LMAHeureuxPorosityDiff
+from marlpde.Evolve_scenario import build_equation
+
+def test_numba_rhs_matches_numpy_rhs():
+    '''
+    The numba compiled right-hand side, used by the explicit solvers with
+    backend="numba", should give the same evolution rates as the numpy
+    implementation in evolution_rate. The uniform initial state would hide
+    errors in the spatial derivatives, so it is perturbed by smooth random
+    noise first.
+    '''
+    Number_of_depths = 40
+    all_kwargs = asdict(Map_Scenario()) | asdict(Solver()) | \
+                 asdict(Tracker()) | {"N": Number_of_depths}
+    eq, state, depths = build_equation(**all_kwargs)
+
+    rng = np.random.default_rng(seed=42)
+    x = depths.axes_coords[0] / depths.axes_bounds[0][1]
+    for field in state.data:
+        # A few low frequency sines with random amplitudes and phases keep
+        # the perturbed fields smooth and, for the porosity, within (0, 1).
+        noise = sum(rng.uniform(-1, 1) * np.sin(np.pi * (k * x + 
+                    rng.uniform())) for k in range(1, 4))
+        field += 0.02 * field * noise
+
+    numpy_rate = eq.evolution_rate(state).data
+    numba_rate = eq._make_pde_rhs_numba(state)(state.data, 0)
+
+    assert np.allclose(numpy_rate, numba_rate)
+
+def test_jacobian_sparsity():
+    '''
+    Every field at a depth only depends on the five fields at that depth and
+    at the two neighbouring depths, so the sparsity pattern of the Jacobian
+    should consist of 5 x 5 tridiagonal blocks, one for every pair of fields.
+    '''
+    Number_of_depths = 10
+    sparsity = LMAHeureuxPorosityDiff.jacobian_sparsity(Number_of_depths)
+
+    assert sparsity.shape == (5 * Number_of_depths, 5 * Number_of_depths)
+
+    tridiagonal = np.eye(Number_of_depths, k=-1) + np.eye(Number_of_depths) + \
+                  np.eye(Number_of_depths, k=1)
+    expected_pattern = np.tile(tridiagonal, (5, 5)) != 0
+    assert np.array_equal(sparsity.toarray() != 0, expected_pattern)
+    # No explicitly stored zeros, which would be probed needlessly.
+    assert sparsity.nnz == 25 * (3 * Number_of_depths - 2)